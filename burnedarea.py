@@ -1,20 +1,34 @@
 import glob
 import rasterio
-from rasterio.mask import mask
+from rasterio.features import geometry_mask
 from rasterio.merge import merge
+from rasterio.vrt import WarpedVRT
+from rasterio.warp import calculate_default_transform, aligned_target, Resampling
+from rasterio.crs import CRS
+from rasterio.transform import Affine
+from rasterio.windows import Window
+from rasterio.windows import transform as window_transform
+from collections import Counter
 import numpy as np
 import geopandas as gpd
 from shapely.geometry import box, Polygon
 from fiona.crs import from_epsg
 import argparse
+import json
 import sys
 import os
 
 
+# rows and columns of the intermediate stores are padded
+# to a multiple of this, and computations run over row blocks
+BLOCK_SIZE = 512
+
+
 class BurnedArea():
 
     def __init__(self, region, date, work_dir,
-                nbr_threshold, ndwi_threshold):
+                nbr_threshold, ndwi_threshold, num_threads=1,
+                export_geotiff=False):
 
         self.region = region
         self.date = date
@@ -24,9 +38,12 @@ class BurnedArea():
         self.geojson = self.work_dir + region + '.geojson'
         self.nbr_threshold = nbr_threshold
         self.ndwi_threshold = ndwi_threshold
+        self.num_threads = num_threads
+        self.export_geotiff = export_geotiff
+        self.grid_cache_fname = self.region_dir + '/grid_cache.json'
 
-        nbr_mosaic_fname = self.region_dir + '/NBR_mosaic.tif'
-        ndwi_mosaic_fname = self.region_dir + '/NDWI_mosaic.tif'
+        self.nbr_mosaic_fname = self.region_dir + '/NBR_mosaic'
+        self.ndwi_mosaic_fname = self.region_dir + '/NDWI_mosaic'
 
         print('Finding burned area for the following parameters:')
         print('region: {}'.format(self.region))
@@ -37,46 +54,54 @@ class BurnedArea():
         print('geojson: {}'.format(self.geojson))
         print('nbr_threshold: {}'.format(self.nbr_threshold))
         print('ndwi_threshold: {}'.format(self.ndwi_threshold))
-        print('nbr_mosaic: {}'.format(nbr_mosaic_fname))
-        print('ndwi_mosaic: {}'.format(ndwi_mosaic_fname))
+        print('num_threads: {}'.format(self.num_threads))
+        print('export_geotiff: {}'.format(self.export_geotiff))
+        print('nbr_mosaic: {}'.format(self.nbr_mosaic_fname))
+        print('ndwi_mosaic: {}'.format(self.ndwi_mosaic_fname))
 
         df = gpd.read_file(self.geojson)
         self.polygon = df['geometry'][0]
 
+    def FindBurnedArea(self):
+        '''
+        Computes the burned and total area
+        (in ha) inside the region polygon,
+        building the mosaic if needed.
+        '''
+        nbr_mosaic_fname = self.nbr_mosaic_fname
+        ndwi_mosaic_fname = self.ndwi_mosaic_fname
+
         # check if mosaic exists, create otherwise
 
-        if not os.path.isfile(nbr_mosaic_fname) or  not os.path.isfile(ndwi_mosaic_fname):
+        if not self.StoreExists(nbr_mosaic_fname) or not self.StoreExists(ndwi_mosaic_fname):
             print('Building mosaic...')
             self.BuildMosaic()
 
-        # read mosaic and crop it to match GeoJSON
-        nbr_mosaic = rasterio.open(nbr_mosaic_fname)
-        ndwi_mosaic = rasterio.open(ndwi_mosaic_fname)
+        # map mosaic from disk, pixels are only read as they are used
+        nbr_mosaic, nbr_meta = self.OpenStore(nbr_mosaic_fname)
+        ndwi_mosaic, ndwi_meta = self.OpenStore(ndwi_mosaic_fname)
 
-        print('Cropping according to GeoJSON polygon...')
-        # NBR
-        geo = gpd.GeoDataFrame({'geometry': self.polygon}, index=[
-                                0], crs=from_epsg(4326))
-        geo = geo.to_crs(crs=nbr_mosaic.crs.data)
-        coords = self.getFeatures(geo)
-        masked_nbr_mosaic, out_transform = mask(
-            dataset=nbr_mosaic, shapes=coords, crop=False, nodata=np.nan)
+        if nbr_mosaic.shape != ndwi_mosaic.shape or \
+           nbr_meta['transform'] != ndwi_meta['transform']:
+            sys.exit('NBR and NDWI mosaics are not on the same grid. Aborting...')
 
-        # NDWI
+        print('Cropping according to GeoJSON polygon...')
         geo = gpd.GeoDataFrame({'geometry': self.polygon}, index=[
                                 0], crs=from_epsg(4326))
-        geo = geo.to_crs(crs=ndwi_mosaic.crs.data)
+        geo = geo.to_crs(crs=nbr_meta['crs'].to_wkt())
         coords = self.getFeatures(geo)
-        masked_ndwi_mosaic, out_transform = mask(
-            dataset=ndwi_mosaic, shapes=coords, crop=False, nodata=np.nan)
 
-        burned_area, total_area = self.GetBurnedArea(nbr=masked_nbr_mosaic[0],
-                                                ndwi=masked_ndwi_mosaic[0])
+        burned_area, total_area = self.GetBurnedArea(nbr=nbr_mosaic,
+                                                ndwi=ndwi_mosaic,
+                                                shapes=coords,
+                                                transform=nbr_meta['transform'])
 
         print('Total area covered: {} ha'.format(total_area))
         print('Burned area: {} ha'.format(burned_area))
         print('Burned fraction: {}'.format(burned_area * 1./total_area))
 
+        return burned_area, total_area
+
     def BuildMosaic(self):
         '''
         Builds a mosaic out of 
@@ -86,53 +111,293 @@ class BurnedArea():
         nbr_tiles = glob.glob(self.region_dir + '/*/NBR.tif')
         ndwi_tiles = glob.glob(self.region_dir + '/*/NDWI.tif')
 
-        nbr_mosaic, nbr_meta = self.MergeRasters(dataset=nbr_tiles)
-        ndwi_mosaic, ndwi_meta = self.MergeRasters(dataset=ndwi_tiles)
+        self.grid_cache = self.ReadGridCache()
+
+        # both mosaics must share a grid, so pick the CRS once
+        dst_crs = self.TargetCRS(dataset=nbr_tiles)
+
+        out_nbr = self.nbr_mosaic_fname
+        self.MergeRasters(dataset=nbr_tiles, dst_crs=dst_crs, fname=out_nbr)
+
+        out_ndwi = self.ndwi_mosaic_fname
+        self.MergeRasters(dataset=ndwi_tiles, dst_crs=dst_crs, fname=out_ndwi)
 
-        out_nbr = self.region_dir + '/NBR_mosaic.tif'
-        with rasterio.open(out_nbr, 'w', **nbr_meta) as dest:
-            dest.write(nbr_mosaic)
+        self.WriteGridCache()
 
-        out_ndwi = self.region_dir + '/NDWI_mosaic.tif'
-        with rasterio.open(out_ndwi, 'w', **ndwi_meta) as dest:
-            dest.write(ndwi_mosaic)
+        if self.export_geotiff:
+            print('Exporting mosaic to GeoTIFF...')
+            self.ExportGeoTIFF(out_nbr)
+            self.ExportGeoTIFF(out_ndwi)
 
-    def MergeRasters(self, dataset):
+    def TargetCRS(self, dataset):
         '''
-        Merges a set or rasters
-        to build a mosaic.
+        Returns the most common CRS among
+        a set of rasters. Ties are broken
+        by the CRS string, so the choice
+        does not depend on file order.
+        '''
+        crs_counts = Counter()
+
+        for raster in dataset:
+            with rasterio.open(raster) as src:
+                crs_counts[src.crs.to_string()] += 1
+
+        return CRS.from_string(min(crs_counts,
+                                   key=lambda crs: (-crs_counts[crs], crs)))
+
+    def MergeRasters(self, dataset, dst_crs, fname):
+        '''
+        Merges a set or rasters into
+        the store fname, one block of rows
+        at a time, so the full mosaic is
+        never held in memory. Tiles in a
+        different CRS (e.g. from a
+        neighbouring UTM zone) are warped
+        onto the grid of dst_crs.
         '''
         src_files_to_mosaic = []
 
         for raster in dataset:
             src = rasterio.open(raster)
             src_files_to_mosaic.append(src)
-            
-        mosaic, out_trans = merge(src_files_to_mosaic)
 
-        out_meta = src.meta.copy()
+        # reference tile already in the target CRS
+        ref = [src for src in src_files_to_mosaic if src.crs == dst_crs][0]
+        nodata = None
+
+        if any(src.crs != dst_crs for src in src_files_to_mosaic):
+            print('Tiles span several CRSs, reprojecting to {}...'.format(
+                dst_crs.to_string()))
+            src_files_to_mosaic = [
+                src if src.crs == dst_crs
+                else self.WarpRaster(src, dst_crs, ref.res)
+                for src in src_files_to_mosaic]
+            # warped tiles are padded with NaN outside their footprint,
+            # which must not overwrite valid pixels from other tiles
+            nodata = np.nan
+
+        # grid of the whole mosaic, computed as merge does
+        xres, yres = ref.res
+        west = min(src.bounds.left for src in src_files_to_mosaic)
+        south = min(src.bounds.bottom for src in src_files_to_mosaic)
+        east = max(src.bounds.right for src in src_files_to_mosaic)
+        north = max(src.bounds.top for src in src_files_to_mosaic)
+        width = int(round((east - west) / xres))
+        height = int(round((north - south) / yres))
+        out_trans = Affine.translation(west, north) * Affine.scale(xres, -yres)
+
+        store = self.CreateStore(fname, height, width, ref.dtypes[0])
+
+        for row in range(0, height, BLOCK_SIZE):
+            rows = min(BLOCK_SIZE, height - row)
+            left, top = out_trans * (0, row)
+            right, bottom = out_trans * (width, row + rows)
+            block, _ = merge(src_files_to_mosaic,
+                             bounds=(left, bottom, right, top),
+                             res=ref.res,
+                             nodata=nodata)
+            store[row:row + rows, :width] = block[0, :rows, :width]
+
+        store.flush()
+        del store
+
+        out_meta = ref.meta.copy()
         out_meta.update({"driver": "GTiff",
-                        "height": mosaic.shape[1],
-                        "width": mosaic.shape[2],
+                        "height": height,
+                        "width": width,
                         "transform": out_trans,
-                        "crs": src.crs,
-                        "dtype": src.dtypes[0]
+                        "crs": dst_crs,
+                        "dtype": ref.dtypes[0]
                         }
                         )
+        if nodata is not None:
+            out_meta["nodata"] = nodata
 
-        return mosaic, out_meta
+        self.WriteSidecar(fname, out_meta)
 
-    def GetBurnedArea(self, nbr, ndwi):
+    def WarpRaster(self, src, dst_crs, resolution):
+        '''
+        Returns a virtual view of a raster
+        warped onto the target grid. Pixels
+        are reprojected window by window
+        as they are read by merge.
+        '''
+        transform, width, height = self.GetWarpGrid(src, dst_crs, resolution)
+
+        return WarpedVRT(src,
+                         crs=dst_crs,
+                         transform=transform,
+                         width=width,
+                         height=height,
+                         nodata=np.nan,
+                         resampling=Resampling.nearest,
+                         num_threads=self.num_threads)
+
+    def GetWarpGrid(self, src, dst_crs, resolution):
+        '''
+        Returns the transform and shape of
+        a raster on the target grid, reusing
+        the cached grid if the raster has
+        not changed since it was computed.
+        '''
+        fname = os.path.abspath(src.name)
+        stat = os.stat(fname)
+        key = {'mtime': stat.st_mtime,
+               'size': stat.st_size,
+               'crs': dst_crs.to_string(),
+               'resolution': list(resolution)}
+
+        cached = self.grid_cache.get(fname)
+        if cached is not None and cached['key'] == key:
+            return Affine(*cached['transform']), cached['width'], cached['height']
+
+        transform, width, height = calculate_default_transform(
+            src.crs, dst_crs, src.width, src.height, *src.bounds,
+            resolution=resolution)
+        # snap to the pixel grid of the target tiles
+        transform, width, height = aligned_target(
+            transform, width, height, resolution)
+
+        self.grid_cache[fname] = {'key': key,
+                                  'transform': list(transform)[:6],
+                                  'width': width,
+                                  'height': height}
+
+        return transform, width, height
+
+    def ReadGridCache(self):
+        '''
+        Reads the cached reprojection
+        grids of the region tiles.
+        '''
+        if not os.path.isfile(self.grid_cache_fname):
+            return {}
 
-        water_mask = ndwi < self.ndwi_threshold
-        burned_mask = nbr > self.nbr_threshold
+        with open(self.grid_cache_fname) as f:
+            return json.load(f)
 
-        corrected_burned_mask = np.logical_and(water_mask, burned_mask)
-        corrected_burned_mask = corrected_burned_mask[~np.isnan(corrected_burned_mask)]
-        burned_area = np.sum(corrected_burned_mask.flatten())
+    def WriteGridCache(self):
+        '''
+        Writes the reprojection grids
+        of the region tiles to disk.
+        '''
+        with open(self.grid_cache_fname, 'w') as f:
+            json.dump(self.grid_cache, f, indent=2)
 
-        nbr = nbr[~np.isnan(nbr)]
-        total_area = len(nbr.flatten())
+    def CreateStore(self, fname, height, width, dtype):
+        '''
+        Creates a raw block-aligned array
+        (fname.dat) to be filled in, and
+        returns it mapped for writing. The
+        store is only complete once
+        WriteSidecar has run.
+        '''
+        # drop any old sidecar first, so an interrupted
+        # rebuild is not mistaken for a complete store
+        if os.path.isfile(fname + '.json'):
+            os.remove(fname + '.json')
+
+        shape = (self.BlockAlign(height), self.BlockAlign(width))
+
+        return np.memmap(fname + '.dat', dtype=dtype,
+                         mode='w+', shape=shape)
+
+    def WriteSidecar(self, fname, meta):
+        '''
+        Writes the JSON sidecar (fname.json)
+        holding the shape and georeferencing
+        of the store fname.dat.
+        '''
+        height, width = meta['height'], meta['width']
+        nodata = meta.get('nodata')
+        # NaN is not valid JSON
+        if nodata is not None and np.isnan(nodata):
+            nodata = 'nan'
+
+        sidecar = {'height': height,
+                   'width': width,
+                   'shape': [self.BlockAlign(height), self.BlockAlign(width)],
+                   'dtype': np.dtype(meta['dtype']).name,
+                   'crs': meta['crs'].to_wkt(),
+                   'transform': list(meta['transform'])[:6],
+                   'nodata': nodata}
+        with open(fname + '.json', 'w') as f:
+            json.dump(sidecar, f, indent=2, allow_nan=False)
+
+    def OpenStore(self, fname):
+        '''
+        Maps a store written by MergeRasters
+        without reading or copying its data.
+        Returns the array and its georeferencing.
+        '''
+        with open(fname + '.json') as f:
+            sidecar = json.load(f)
+
+        store = np.memmap(fname + '.dat', dtype=sidecar['dtype'],
+                          mode='r', shape=tuple(sidecar['shape']))
+        # drop the block padding, slicing keeps this a view
+        array = store[:sidecar['height'], :sidecar['width']]
+
+        nodata = sidecar['nodata']
+        if nodata is not None:
+            nodata = float(nodata)
+
+        meta = {'driver': 'GTiff',
+                'count': 1,
+                'height': sidecar['height'],
+                'width': sidecar['width'],
+                'dtype': sidecar['dtype'],
+                'crs': CRS.from_wkt(sidecar['crs']),
+                'transform': Affine(*sidecar['transform']),
+                'nodata': nodata}
+
+        return array, meta
+
+    def StoreExists(self, fname):
+        return os.path.isfile(fname + '.dat') and os.path.isfile(fname + '.json')
+
+    def ExportGeoTIFF(self, fname):
+        '''
+        Writes a store out as fname.tif.
+        '''
+        array, meta = self.OpenStore(fname)
+        height, width = array.shape
+
+        with rasterio.open(fname + '.tif', 'w', **meta) as dest:
+            for row in range(0, height, BLOCK_SIZE):
+                window = Window(0, row, width, min(BLOCK_SIZE, height - row))
+                dest.write(array[row:row + window.height], 1, window=window)
+
+    def BlockAlign(self, n):
+        return -(-n // BLOCK_SIZE) * BLOCK_SIZE
+
+    def GetBurnedArea(self, nbr, ndwi, shapes, transform):
+        '''
+        Counts burned and valid pixels inside
+        the given shapes, one block of rows at
+        a time so that only the block being
+        processed is paged in from the store.
+        '''
+        burned_area = 0
+        total_area = 0
+        height, width = nbr.shape
+
+        for row in range(0, height, BLOCK_SIZE):
+            window = Window(0, row, width, min(BLOCK_SIZE, height - row))
+            inside = geometry_mask(shapes,
+                                   out_shape=(window.height, width),
+                                   transform=window_transform(window, transform),
+                                   invert=True)
+
+            nbr_block = nbr[row:row + window.height]
+            ndwi_block = ndwi[row:row + window.height]
+
+            water_mask = ndwi_block < self.ndwi_threshold
+            burned_mask = nbr_block > self.nbr_threshold
+
+            corrected_burned_mask = inside & water_mask & burned_mask
+            burned_area += np.count_nonzero(corrected_burned_mask)
+            total_area += np.count_nonzero(inside & ~np.isnan(nbr_block))
 
         burned_area *= 10**2 * 1e-4
         total_area *= 10**2 * 1e-4        
@@ -145,23 +410,25 @@ class BurnedArea():
         return [json.loads(gdf.to_json())['features'][0]['geometry']]
 
 
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='')
 
+    parser.add_argument('--region', type=str, required=True, help='GeoJSON file of region to search.')
+    parser.add_argument('--date', type=str, required=True, help='Fire date in format YYYYMMDD')
+    parser.add_argument('--work_dir', type=str, required=True, help='Directory to place files.')
+    parser.add_argument('--nbr_threshold', type=float, default=0.3, help='Threshold to define a burned pixel.')
+    parser.add_argument('--ndwi_threshold', type=float, default=0.0, help='Threshold to define a water pixel.')
+    parser.add_argument('--export_geotiff', action='store_true', help='Also write the mosaics as GeoTIFF.')
+    parser.add_argument('--num_threads', type=int, default=os.cpu_count(), help='Number of threads used to reproject tiles.')
 
+    args = parser.parse_args()
 
-parser = argparse.ArgumentParser(description='')
-
-parser.add_argument('--region', type=str, required=True, help='GeoJSON file of region to search.')
-parser.add_argument('--date', type=str, required=True, help='Fire date in format YYYYMMDD')
-parser.add_argument('--work_dir', type=str, required=True, help='Directory to place files.')
-parser.add_argument('--nbr_threshold', type=float, default=0.3, help='Threshold to define a burned pixel.')
-parser.add_argument('--ndwi_threshold', type=float, default=0.0, help='Threshold to define a water pixel.')
-
-args = parser.parse_args() 
-
-burned = BurnedArea(region=args.region,
-                   date=args.date,
-                   work_dir=args.work_dir,
-                   nbr_threshold=args.nbr_threshold,
-                   ndwi_threshold=args.ndwi_threshold)
-
+    burned = BurnedArea(region=args.region,
+                       date=args.date,
+                       work_dir=args.work_dir,
+                       nbr_threshold=args.nbr_threshold,
+                       ndwi_threshold=args.ndwi_threshold,
+                       num_threads=args.num_threads,
+                       export_geotiff=args.export_geotiff)
 
+    burned.FindBurnedArea()
@@ -126,7 +126,7 @@ class Sentinel2:
                 self.download_tile_aws(self.post_titles[i], download_dir)
 
 
-    def download_tile_aws(self, title, download_dir):
+    def download_tile_aws(self, title, download_dir, check=False):
 
         cmd = ['sentinelhub.aws',
             '--product',
@@ -134,7 +134,10 @@ class Sentinel2:
             '-f',
             download_dir]
 
-        subprocess.call(cmd)
+        if check:
+            subprocess.check_call(cmd)
+        else:
+            subprocess.call(cmd)
 
 
     def get_bbox_from_geojson(self, geojson):
@@ -248,17 +251,20 @@ class Sentinel2:
 
         return titles, tiles, dates
 
-parser = argparse.ArgumentParser(description='')
 
-parser.add_argument('--geojson', type=str, required=True, help='GeoJSON file of region to search.')
-parser.add_argument('--date', type=str, required=True, help='Fire date in format YYYYMMDD')
-parser.add_argument('--work_dir', type=str, required=True, help='Directory to place files.')
-parser.add_argument('--delta_days', type=int, help='Number of days between the event and the pre/post fire observations.')
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='')
 
-args = parser.parse_args() 
+    parser.add_argument('--geojson', type=str, required=True, help='GeoJSON file of region to search.')
+    parser.add_argument('--date', type=str, required=True, help='Fire date in format YYYYMMDD')
+    parser.add_argument('--work_dir', type=str, required=True, help='Directory to place files.')
+    parser.add_argument('--delta_days', type=int, help='Number of days between the event and the pre/post fire observations.')
 
-search = Sentinel2(geojson=args.geojson,
-                   date=args.date,
-                   work_dir=args.work_dir)
+    args = parser.parse_args()
 
-search.download_tiles()
+    search = Sentinel2(geojson=args.geojson,
+                       date=args.date,
+                       work_dir=args.work_dir,
+                       delta_days=args.delta_days)
+
+    search.download_tiles()
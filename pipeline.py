@@ -0,0 +1,413 @@
+import subprocess
+import threading
+import hashlib
+import shutil
+import glob
+import json
+import sys
+import os
+import argparse
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from download import Sentinel2
+from burnedarea import BurnedArea
+
+SRC = os.path.dirname(os.path.abspath(__file__))
+
+
+class Stage:
+    '''
+    A node of the pipeline DAG. Inputs and outputs
+    are glob patterns, whose contents are fingerprinted
+    to decide whether the stage needs to run again.
+    '''
+
+    def __init__(self, name, run, inputs, outputs, deps=(),
+                 params=None, pool='cpu', always=False):
+        self.name = name
+        self.run = run
+        self.inputs = list(inputs)
+        self.outputs = list(outputs)
+        self.deps = list(deps)
+        self.params = params or {}
+        self.pool = pool
+        # run on every pass, without fingerprinting
+        self.always = always
+
+
+class Fingerprints:
+    '''
+    Content digests of files and directories, plus
+    the fingerprints each stage saw the last time it
+    ran. Digests are only recomputed when the size or
+    mtime of a file changes.
+    '''
+
+    def __init__(self, fname):
+        self.fname = fname
+        self.lock = threading.Lock()
+
+        if os.path.isfile(self.fname):
+            with open(self.fname) as f:
+                state = json.load(f)
+        else:
+            state = {}
+
+        self.files = state.get('files', {})
+        self.stages = state.get('stages', {})
+
+    def save(self):
+        with self.lock:
+            state = {'files': self.files, 'stages': self.stages}
+            tmp = self.fname + '.tmp'
+            with open(tmp, 'w') as f:
+                json.dump(state, f, indent=2)
+            os.replace(tmp, self.fname)
+
+    def file_digest(self, path):
+        path = os.path.realpath(path)
+        stat = os.stat(path)
+        key = [stat.st_size, stat.st_mtime_ns]
+
+        with self.lock:
+            cached = self.files.get(path)
+        if cached is not None and cached['key'] == key:
+            return cached['digest']
+
+        sha = hashlib.sha1()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                sha.update(chunk)
+        digest = sha.hexdigest()
+
+        with self.lock:
+            self.files[path] = {'key': key, 'digest': digest}
+
+        return digest
+
+    def path_digest(self, path):
+        '''
+        Digest of a file, or of every file
+        under a directory (e.g. a .SAFE product).
+        '''
+        if not os.path.isdir(path):
+            return self.file_digest(path)
+
+        sha = hashlib.sha1()
+        for root, dirs, files in os.walk(path, followlinks=True):
+            dirs.sort()
+            for name in sorted(files):
+                fname = os.path.join(root, name)
+                sha.update(os.path.relpath(fname, path).encode())
+                sha.update(self.file_digest(fname).encode())
+
+        return sha.hexdigest()
+
+    def digest(self, patterns, params=None):
+        '''
+        Combined digest of everything matched by
+        a list of glob patterns. Returns None if
+        any of the patterns matches nothing.
+        '''
+        sha = hashlib.sha1()
+        sha.update(json.dumps(params or {}, sort_keys=True).encode())
+
+        for pattern in patterns:
+            paths = sorted(glob.glob(pattern))
+            if len(paths) == 0:
+                return None
+            for path in paths:
+                sha.update(path.encode())
+                sha.update(self.path_digest(path).encode())
+
+        return sha.hexdigest()
+
+    def is_fresh(self, stage):
+        with self.lock:
+            record = self.stages.get(stage.name)
+        if record is None:
+            return False
+
+        inputs = self.digest(stage.inputs, stage.params)
+        outputs = self.digest(stage.outputs)
+
+        return outputs is not None and \
+            record['inputs'] == inputs and record['outputs'] == outputs
+
+    def record(self, stage):
+        inputs = self.digest(stage.inputs, stage.params)
+        outputs = self.digest(stage.outputs)
+
+        with self.lock:
+            self.stages[stage.name] = {'inputs': inputs, 'outputs': outputs}
+        self.save()
+
+
+class Pipeline:
+    '''
+    Runs a DAG of stages. A stage is submitted as soon
+    as all of its dependencies are done, so every tile
+    moves on to the next stage independently of the
+    other tiles in its region. Stages may add new
+    stages while they run.
+    '''
+
+    def __init__(self, state_fname, num_procs=1, num_downloads=2):
+        self.stages = {}
+        self.lock = threading.Lock()
+        self.fingerprints = Fingerprints(state_fname)
+        self.num_procs = num_procs
+        self.num_downloads = num_downloads
+
+    def add(self, stage):
+        with self.lock:
+            if stage.name not in self.stages:
+                self.stages[stage.name] = stage
+            return self.stages[stage.name]
+
+    def run_stage(self, stage):
+        if stage.always:
+            print('[{}] running...'.format(stage.name))
+            stage.run()
+            return
+
+        if self.fingerprints.is_fresh(stage):
+            print('[{}] up to date, skipping'.format(stage.name))
+            return
+
+        # stale outputs are removed first, as the stages
+        # themselves skip anything that already exists
+        for pattern in stage.outputs:
+            for path in glob.glob(pattern):
+                if os.path.isdir(path) and not os.path.islink(path):
+                    shutil.rmtree(path)
+                else:
+                    os.remove(path)
+
+        print('[{}] running...'.format(stage.name))
+        stage.run()
+
+        if self.fingerprints.digest(stage.outputs) is None:
+            raise RuntimeError('[{}] did not produce {}'.format(
+                stage.name, ', '.join(stage.outputs)))
+
+        self.fingerprints.record(stage)
+        print('[{}] done'.format(stage.name))
+
+    def run(self):
+        pools = {'cpu': ThreadPoolExecutor(self.num_procs),
+                 'download': ThreadPoolExecutor(self.num_downloads)}
+
+        scheduled = set()
+        running = {}
+        done = set()
+        failed = set()
+
+        while True:
+            # rescan until nothing changes, so that skipping
+            # a stage also skips everything downstream of it
+            changed = True
+            while changed:
+                changed = False
+                with self.lock:
+                    pending = [stage for name, stage in self.stages.items()
+                               if name not in scheduled]
+
+                for stage in pending:
+                    if any(dep in failed for dep in stage.deps):
+                        print('[{}] skipped, an upstream stage failed'.format(stage.name))
+                        failed.add(stage.name)
+                        scheduled.add(stage.name)
+                        changed = True
+                    elif all(dep in done for dep in stage.deps):
+                        future = pools[stage.pool].submit(self.run_stage, stage)
+                        running[future] = stage.name
+                        scheduled.add(stage.name)
+
+            if not running:
+                break
+
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                name = running.pop(future)
+                try:
+                    future.result()
+                    done.add(name)
+                # Sentinel2 calls sys.exit when a search fails
+                except (Exception, SystemExit) as e:
+                    print('[{}] failed: {}'.format(name, e))
+                    failed.add(name)
+
+        for pool in pools.values():
+            pool.shutdown()
+
+        return failed
+
+
+def add_tile_stages(pipeline, search, tile, pre_title, post_title):
+    '''
+    Adds download, atmospheric correction and index
+    building for one tile. Tiles shared between regions
+    are symlinked to the same directory, so stages are
+    named after the real path and only added once.
+    '''
+    tile_dir = os.path.join(search.region_dir, tile)
+    tile_key = os.path.realpath(tile_dir)
+    pre_dir = os.path.join(tile_dir, 'pre')
+    post_dir = os.path.join(tile_dir, 'post')
+
+    def download():
+        for title, download_dir in [(pre_title, pre_dir), (post_title, post_dir)]:
+            print('Downloading product: {}'.format(title))
+            search.download_tile_aws(title, download_dir, check=True)
+
+    def sen2cor():
+        for product in glob.glob(os.path.join(tile_dir, '*', '*L1C*')):
+            subprocess.check_call(['L2A_Process', '--resolution', '10', product])
+
+    def buildmaps():
+        subprocess.check_call([sys.executable, os.path.join(SRC, 'buildmaps.py'),
+                               '--tileid', tile_dir])
+
+    download_stage = pipeline.add(Stage(
+        name='download:' + tile_key,
+        run=download,
+        inputs=[],
+        # only the L1C products, sen2cor writes into the same directories
+        outputs=[os.path.join(pre_dir, '*L1C*'), os.path.join(post_dir, '*L1C*')],
+        params={'pre': pre_title, 'post': post_title},
+        pool='download'))
+
+    sen2cor_stage = pipeline.add(Stage(
+        name='sen2cor:' + tile_key,
+        run=sen2cor,
+        inputs=[os.path.join(pre_dir, '*L1C*'), os.path.join(post_dir, '*L1C*')],
+        outputs=[os.path.join(pre_dir, '*L2A*'), os.path.join(post_dir, '*L2A*')],
+        deps=[download_stage.name]))
+
+    indices_stage = pipeline.add(Stage(
+        name='indices:' + tile_key,
+        run=buildmaps,
+        inputs=[os.path.join(pre_dir, '*'), os.path.join(post_dir, '*')],
+        outputs=[os.path.join(tile_dir, fname)
+                 for fname in ['NBR.tif', 'NDWI.tif', 'NDVI.tif']],
+        deps=[sen2cor_stage.name]))
+
+    return indices_stage
+
+
+def add_region_stages(pipeline, args, geojson):
+    '''
+    Adds the product search of a region. The search
+    runs as a stage of its own, so tiles of regions
+    already searched start downloading in the meantime.
+    '''
+    pipeline.add(Stage(
+        name='search:' + geojson,
+        run=lambda: add_search_stages(pipeline, args, geojson),
+        inputs=[],
+        outputs=[],
+        pool='download',
+        always=True))
+
+
+def add_search_stages(pipeline, args, geojson):
+    '''
+    Searches the products of a region and adds its
+    tiles, followed by the mosaic and statistics stages.
+    '''
+    search = Sentinel2(geojson=geojson,
+                       date=args.date,
+                       work_dir=args.work_dir,
+                       delta_days=args.delta_days)
+
+    region = search.region_name
+    region_dir = search.region_dir
+
+    tile_stages = [add_tile_stages(pipeline, search, search.pre_tiles[i],
+                                   search.pre_titles[i], search.post_titles[i])
+                   for i in range(len(search.pre_tiles))]
+
+    def burned_area():
+        # BurnedArea expects a trailing separator in work_dir
+        return BurnedArea(region=region,
+                          date=args.date,
+                          work_dir=os.path.join(args.work_dir, ''),
+                          nbr_threshold=args.nbr_threshold,
+                          ndwi_threshold=args.ndwi_threshold,
+                          num_threads=args.num_threads,
+                          export_geotiff=args.export_geotiff)
+
+    def mosaic():
+        burned_area().BuildMosaic()
+
+    def statistics():
+        burned, total = burned_area().FindBurnedArea()
+        with open(os.path.join(region_dir, 'burnedarea.json'), 'w') as f:
+            json.dump({'burned_area': burned,
+                       'total_area': total,
+                       'burned_fraction': burned * 1./total}, f, indent=2)
+
+    mosaic_fnames = [os.path.join(region_dir, name + ext)
+                     for name in ['NBR_mosaic', 'NDWI_mosaic']
+                     for ext in ['.dat', '.json']]
+    if args.export_geotiff:
+        mosaic_fnames += [os.path.join(region_dir, name + '.tif')
+                          for name in ['NBR_mosaic', 'NDWI_mosaic']]
+
+    mosaic_stage = pipeline.add(Stage(
+        name='mosaic:' + region_dir,
+        run=mosaic,
+        inputs=[os.path.join(region_dir, tile, fname)
+                for tile in search.pre_tiles
+                for fname in ['NBR.tif', 'NDWI.tif']],
+        outputs=mosaic_fnames,
+        deps=[stage.name for stage in tile_stages]))
+
+    pipeline.add(Stage(
+        name='statistics:' + region_dir,
+        run=statistics,
+        inputs=mosaic_fnames + [geojson],
+        outputs=[os.path.join(region_dir, 'burnedarea.json')],
+        params={'nbr_threshold': args.nbr_threshold,
+                'ndwi_threshold': args.ndwi_threshold},
+        deps=[mosaic_stage.name]))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='')
+
+    parser.add_argument('--work_dir', type=str, required=True, help='Directory to place files, containing the GeoJSON files of the regions.')
+    parser.add_argument('--date', type=str, required=True, help='Fire date in format YYYYMMDD')
+    parser.add_argument('--delta_days', type=int, required=True, help='Number of days between the event and the pre/post fire observations.')
+    parser.add_argument('--regions', type=str, nargs='+', help='Regions to process (GeoJSON names without extension). Defaults to all in work_dir.')
+    parser.add_argument('--nbr_threshold', type=float, default=0.3, help='Threshold to define a burned pixel.')
+    parser.add_argument('--ndwi_threshold', type=float, default=0.0, help='Threshold to define a water pixel.')
+    parser.add_argument('--num_procs', type=int, default=1, help='Number of tiles processed at the same time.')
+    parser.add_argument('--num_downloads', type=int, default=2, help='Number of tiles downloaded at the same time.')
+    parser.add_argument('--num_threads', type=int, default=os.cpu_count(), help='Number of threads used to reproject tiles.')
+    parser.add_argument('--export_geotiff', action='store_true', help='Also write the mosaics as GeoTIFF.')
+
+    args = parser.parse_args()
+
+    if args.regions:
+        geojsons = [os.path.join(args.work_dir, region + '.geojson')
+                    for region in args.regions]
+    else:
+        geojsons = sorted(glob.glob(os.path.join(args.work_dir, '*.geojson')))
+
+    date_dir = os.path.join(args.work_dir, args.date)
+    if not os.path.exists(date_dir):
+        os.makedirs(date_dir)
+
+    pipeline = Pipeline(state_fname=os.path.join(date_dir, 'pipeline_state.json'),
+                        num_procs=args.num_procs,
+                        num_downloads=args.num_downloads)
+
+    for geojson in geojsons:
+        add_region_stages(pipeline, args, geojson)
+
+    failed = pipeline.run()
+
+    if failed:
+        sys.exit('{} stages failed or were skipped.'.format(len(failed)))